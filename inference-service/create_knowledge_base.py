@@ -1,15 +1,20 @@
 import pandas as pd
 import json
 
-def clean_symptoms(row):
-    """Gathers all non-empty symptoms from a row into a clean list."""
-    symptoms = []
-    for i in range(1, 18):
-        symptom_col = f'Symptom_{i}'
-        if pd.notna(row.get(symptom_col)):
-            symptom = str(row[symptom_col]).strip().replace('_', ' ')
-            symptoms.append(symptom)
-    return symptoms
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SYMPTOM_COLS = tuple(f'Symptom_{i}' for i in range(1, 18))
+PRECAUTION_COLS = tuple(f'Precaution_{i}' for i in range(1, 5))
+
+def read_csv(path, usecols):
+    """Reads only the needed columns, using the multi-threaded pyarrow parser when installed."""
+    try:
+        return pd.read_csv(path, usecols=usecols, engine='pyarrow', dtype_backend='pyarrow')
+    except ImportError:
+        return pd.read_csv(path, usecols=usecols, dtype=str)
 
 def create_knowledge_base():
     """
@@ -19,8 +24,8 @@ def create_knowledge_base():
     print("Starting knowledge base creation...")
 
     try:
-        disease_symptoms_df = pd.read_csv('dataset.csv')
-        symptom_precautions_df = pd.read_csv('symptom_precaution.csv')
+        disease_symptoms_df = read_csv('dataset.csv', ['Disease', *SYMPTOM_COLS])
+        symptom_precautions_df = read_csv('symptom_precaution.csv', ['Disease', *PRECAUTION_COLS])
         print("✅ CSV files loaded successfully.")
     except FileNotFoundError as e:
         print(f"❌ Error: Could not find a required CSV file. Missing file: {e.filename}")
@@ -35,46 +40,73 @@ def create_knowledge_base():
         "vomiting": {"name": "Ondansetron"}, "diarrhoea": {"name": "Loperamide"},
         "joint pain": {"name": "Naproxen"}, "continuous sneezing": {"name": "Loratadine"}
     }
-    
-    knowledge_base = {}
+    # Normalize keys once so lookups below are a single dict.get on the cleaned symptom.
+    drug_by_symptom = {symptom.strip().lower(): info["name"] for symptom, info in symptom_drug_map.items()}
 
     print("Processing diseases, symptoms, and mapping drugs...")
-    for index, row in disease_symptoms_df.iterrows():
-        disease = row['Disease']
-        if disease not in knowledge_base:
-            symptoms = clean_symptoms(row)
-            mapped_drugs = []
+    # Only the first row of each disease is used, as before.
+    first_rows = disease_symptoms_df.drop_duplicates('Disease', keep='first')
+    diseases = first_rows['Disease']
 
-            # For each symptom, check if it has a common drug mapping.
-            for symptom in symptoms:
-                if symptom in symptom_drug_map:
-                    drug_info = symptom_drug_map[symptom]
-                    # Avoid adding the same drug multiple times
-                    if not any(d['name'] == drug_info['name'] for d in mapped_drugs):
-                        mapped_drugs.append({"name": drug_info["name"]})
-            
-            knowledge_base[disease] = {
-                "condition_name": disease,
-                "symptoms": symptoms,
-                "general_advice": "Consult a healthcare professional.",
-                "suggested_drugs": mapped_drugs # Drugs are suggested based on symptoms
-            }
+    # Melt Symptom_1..17 into one long column. melt stacks the columns in order,
+    # so each disease keeps its symptoms in their original column order.
+    symptoms_by_disease = (
+        first_rows.melt(id_vars='Disease', value_vars=list(SYMPTOM_COLS))
+        .dropna(subset=['value'])
+        .assign(value=lambda d: d['value'].astype(str).str.strip().str.replace('_', ' ', regex=False).str.lower())
+        .groupby('Disease', sort=False)['value']
+        .apply(list)
+        .reindex(diseases)
+    )
 
     print("Mapping precautions to diseases...")
-    for index, row in symptom_precautions_df.iterrows():
-        disease = row['Disease']
-        if disease in knowledge_base:
-            precautions = [row[f'Precaution_{i}'] for i in range(1, 5) if pd.notna(row[f'Precaution_{i}'])]
-            knowledge_base[disease]['general_advice'] = " ".join(precautions)
+    # Later precaution rows overwrite earlier ones, so keep the last row per disease.
+    # A disease whose precautions are all empty still gets an empty advice string.
+    last_precautions = symptom_precautions_df.drop_duplicates('Disease', keep='last')
+    advice_by_disease = (
+        last_precautions.melt(id_vars='Disease', value_vars=list(PRECAUTION_COLS))
+        .dropna(subset=['value'])
+        .groupby('Disease', sort=False)['value']
+        .agg(' '.join)
+        .reindex(last_precautions['Disease'], fill_value='')
+    )
+
+    def map_drugs(symptoms):
+        """Suggests one drug per mapped symptom, skipping repeats."""
+        mapped_drugs = []
+        seen = set()
+        for symptom in symptoms:
+            drug_name = drug_by_symptom.get(symptom)
+            if drug_name and drug_name not in seen:
+                seen.add(drug_name)
+                mapped_drugs.append({"name": drug_name})
+        return mapped_drugs
+
+    # Assemble every field column-wise and emit the records in one go.
+    knowledge_base = pd.DataFrame({
+        "condition_name": diseases.tolist(),
+        "symptoms": [s if isinstance(s, list) else [] for s in symptoms_by_disease],
+    })
+    knowledge_base["general_advice"] = (
+        advice_by_disease.reindex(knowledge_base["condition_name"])
+        .fillna("Consult a healthcare professional.")
+        .tolist()
+    )
+    # Drugs are suggested based on symptoms
+    knowledge_base["suggested_drugs"] = knowledge_base["symptoms"].map(map_drugs)
 
-    final_data = list(knowledge_base.values())
+    final_data = knowledge_base.to_dict(orient='records')
     
     output_filename = 'medical_data.json'
-    with open(output_filename, 'w') as f:
-        json.dump(final_data, f, indent=2)
+    if orjson is not None:
+        with open(output_filename, 'wb') as f:
+            f.write(orjson.dumps(final_data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_filename, 'w') as f:
+            json.dump(final_data, f, indent=2)
         
     print("-" * 50)
     print(f"🎉 Success! Knowledge base created as '{output_filename}'")
 
 if __name__ == '__main__':
-    create_knowledge_base()
\ No newline at end of file
+    create_knowledge_base()
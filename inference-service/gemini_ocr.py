@@ -5,9 +5,10 @@ Optimized for extracting structured medical data from prescription images
 
 import os
 import io
+import asyncio
 import base64
 import logging
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 from PIL import Image
 from dotenv import load_dotenv
 
@@ -15,6 +16,12 @@ from fastapi import FastAPI, File, UploadFile, HTTPException
 from pydantic import BaseModel
 import google.generativeai as genai
 
+# Optional: libvips shrink-on-load + SIMD resize for large OCR uploads
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
 logger = logging.getLogger(__name__)
 load_dotenv()
 # ============================================================================
@@ -29,12 +36,14 @@ class GeminiConfig:
     
     # Generation settings optimized for structured extraction
     GENERATION_CONFIG = {
-        "temperature": 0.1,  # Low temperature for consistent extraction
-        "top_p": 0.95,
-        "top_k": 40,
+        "temperature": 0.0,  # Greedy decoding for consistent extraction
+        "top_k": 1,
         "max_output_tokens": 2048,
     }
     
+    # Longest image edge sent to Gemini; prescriptions don't need more for OCR
+    MAX_IMAGE_DIMENSION = 2048
+    
     # Safety settings (permissive for medical content)
     SAFETY_SETTINGS = [
         {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
@@ -43,6 +52,48 @@ class GeminiConfig:
         {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
     ]
 
+# Formats Gemini accepts directly, keyed by PIL format name
+GEMINI_IMAGE_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+def prepare_image_for_gemini(image_bytes: bytes, max_dimension: int) -> Tuple[bytes, str]:
+    """
+    Return image bytes and MIME type ready to send to Gemini.
+
+    Uploads already in a supported format, mode and size are passed through
+    without decoding; anything else is downscaled and re-encoded as JPEG.
+    """
+    # Image.open only parses the header; pixels are decoded on first use
+    image = Image.open(io.BytesIO(image_bytes))
+    mime_type = GEMINI_IMAGE_MIME_TYPES.get(image.format)
+    
+    if mime_type and image.mode in ('RGB', 'L') and max(image.size) <= max_dimension:
+        # Already usable - send the upload as-is
+        return image_bytes, mime_type
+    
+    if pyvips is not None:
+        # libvips decodes at reduced scale and resizes with SIMD kernels
+        thumb = pyvips.Image.thumbnail_buffer(
+            image_bytes, max_dimension, height=max_dimension, size="down"
+        )
+        if thumb.hasalpha():
+            thumb = thumb.flatten()
+        return thumb.jpegsave_buffer(Q=90), "image/jpeg"
+    
+    # Resize before any conversion so thumbnail() can use JPEG draft mode
+    # and decode straight at a reduced scale
+    image.thumbnail((max_dimension, max_dimension), Image.Resampling.BILINEAR)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    
+    # JPEG is much cheaper than PNG deflate and smaller on the wire
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue(), "image/jpeg"
+
 # Initialize Gemini
 if GeminiConfig.API_KEY:
     genai.configure(api_key=GeminiConfig.API_KEY)
@@ -139,63 +190,35 @@ class GeminiOCRProcessor:
         self.model = genai.GenerativeModel(
             model_name=GeminiConfig.MODEL_NAME,
             generation_config=GeminiConfig.GENERATION_CONFIG,
-            safety_settings=GeminiConfig.SAFETY_SETTINGS
+            safety_settings=GeminiConfig.SAFETY_SETTINGS,
+            # Set once here so each request only carries the image
+            system_instruction=PRESCRIPTION_EXTRACTION_PROMPT
         )
         logger.info(f"✅ Gemini model initialized: {GeminiConfig.MODEL_NAME}")
     
-    def preprocess_image(self, image_bytes: bytes) -> Image.Image:
-        """Preprocess image for better OCR results"""
-        try:
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # Convert to RGB if necessary
-            if image.mode not in ('RGB', 'L'):
-                image = image.convert('RGB')
-            
-            # Resize if too large (Gemini has size limits)
-            max_dimension = 4096
-            if max(image.size) > max_dimension:
-                ratio = max_dimension / max(image.size)
-                new_size = tuple(int(dim * ratio) for dim in image.size)
-                image = image.resize(new_size, Image.Resampling.LANCZOS)
-                logger.info(f"Image resized to {new_size}")
-            
-            # Enhance contrast for better text recognition (optional)
-            # from PIL import ImageEnhance
-            # enhancer = ImageEnhance.Contrast(image)
-            # image = enhancer.enhance(1.5)
-            
-            return image
-            
-        except Exception as e:
-            logger.error(f"Image preprocessing failed: {e}")
-            raise ValueError(f"Invalid image file: {e}")
-    
     def extract_text(self, image_bytes: bytes) -> str:
         """Extract text from prescription image using Gemini Vision"""
         try:
             # Preprocess image
-            image = self.preprocess_image(image_bytes)
-            
-            # Convert to bytes for Gemini
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
+            try:
+                img_byte_arr, mime_type = prepare_image_for_gemini(
+                    image_bytes, GeminiConfig.MAX_IMAGE_DIMENSION
+                )
+            except Exception as e:
+                logger.error(f"Image preprocessing failed: {e}")
+                raise ValueError(f"Invalid image file: {e}")
             
             # Prepare the image part for Gemini
             image_parts = [
                 {
-                    "mime_type": "image/png",
+                    "mime_type": mime_type,
                     "data": img_byte_arr
                 }
             ]
             
             # Generate content with vision
-            logger.info("Sending image to Gemini for OCR...")
-            response = self.model.generate_content([
-                PRESCRIPTION_EXTRACTION_PROMPT,
-                image_parts[0]
-            ])
+            logger.info(f"Sending image to Gemini for OCR ({len(img_byte_arr)} bytes, {mime_type})...")
+            response = self.model.generate_content(image_parts)
             
             # Extract text from response
             if not response or not response.text:
@@ -286,8 +309,8 @@ async def extract_prescription_text(image: UploadFile = File(...)) -> OCRRespons
         
         logger.info(f"Processing image: {image.filename} ({len(image_bytes)} bytes)")
         
-        # Extract text using Gemini
-        extracted_text = gemini_processor.extract_text(image_bytes)
+        # Extract text using Gemini (blocking SDK call, so keep it off the event loop)
+        extracted_text = await asyncio.to_thread(gemini_processor.extract_text, image_bytes)
         
         if not extracted_text or len(extracted_text.strip()) < 10:
             raise HTTPException(
@@ -0,0 +1,28 @@
+"""
+Gunicorn config for running the inference service with several Uvicorn workers
+
+    gunicorn -c gunicorn.conf.py inference_service:app
+"""
+
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8001")
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Each worker loads its own Whisper and embedder in the FastAPI lifespan,
+# so keep this low on a single GPU (the KB embeddings are mmap'd and shared)
+workers = int(os.getenv("WORKERS", "2"))
+
+# No --preload: models load after fork in the lifespan handler, and CUDA
+# can't be initialized in a parent process that forks afterwards
+preload_app = False
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))  # First requests may include model warmup
+keepalive = int(os.getenv("KEEP_ALIVE_TIMEOUT", "30"))
+
+
+def post_fork(server, worker):
+    """Pin workers round-robin to the GPUs listed in WORKER_GPUS (e.g. "0,1")"""
+    gpus = [gpu for gpu in os.getenv("WORKER_GPUS", "").split(",") if gpu]
+    if gpus:
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpus[(worker.age - 1) % len(gpus)]
@@ -1,9 +1,9 @@
 """
 Medical AI Inference Service with Real RAG System
-Integrates optimized Whisper + Real RAG (Chroma + LangChain + Ollama) + Gemini Vision OCR
+Integrates optimized Whisper + Real RAG (embedding search + LangChain + Ollama) + Gemini Vision OCR
 
 This service uses a TRUE RAG (Retrieval-Augmented Generation) pipeline:
-1. Vector retrieval using Chroma for semantic search
+1. Cosine-similarity retrieval over precomputed knowledge base embeddings
 2. Context augmentation with retrieved medical knowledge
 3. LLM generation using Ollama (Meditron) for structured prescription output
 4. Fallback to rule-based defaults if LLM fails
@@ -11,31 +11,41 @@ This service uses a TRUE RAG (Retrieval-Augmented Generation) pipeline:
 
 import os
 import io
+import re
 import json
+import asyncio
+import hashlib
 import logging
+import threading
 import warnings
-from typing import Optional, Dict, List
+from collections import OrderedDict
+from typing import BinaryIO, Optional, Dict, List, Union
 from datetime import datetime, timedelta
-from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
 from dotenv import load_dotenv
 
 import torch
 import uvicorn
-import librosa
-from pydub import AudioSegment
+import numpy as np
+import av
+import soundfile as sf
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.datastructures import Headers
 from pydantic import BaseModel
-from PIL import Image
 
 # Audio processing
-from transformers import WhisperProcessor, WhisperForConditionalGeneration
+from transformers import BitsAndBytesConfig, WhisperProcessor, WhisperForConditionalGeneration
 
 # Real RAG System
 from rag_prescription_generator import RAGPrescriptionGenerator
 
 # Gemini for OCR
 import google.generativeai as genai
+from gemini_ocr import prepare_image_for_gemini
 
 # Configure logging
 logging.basicConfig(
@@ -50,7 +60,10 @@ load_dotenv()
 
 class Config:
     # Model selections
-    WHISPER_MODEL = "openai/whisper-small"
+    WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "faster-whisper")  # or "transformers"
+    WHISPER_MODEL = "openai/whisper-small"  # transformers backend
+    FASTER_WHISPER_MODEL = os.getenv("FASTER_WHISPER_MODEL", "small")  # CTranslate2 size or path
+    FASTER_WHISPER_COMPUTE_TYPE = os.getenv("FASTER_WHISPER_COMPUTE_TYPE")  # Default: int8_float16 on GPU, int8 on CPU
     GEMINI_MODEL = "gemini-2.5-flash"  # Fast and cheap for OCR
     
     # Device
@@ -64,6 +77,34 @@ class Config:
     
     # Performance
     MAX_AUDIO_LENGTH = 30
+    # CPU inference threads; half the cores by default to leave room for the event loop
+    CPU_THREADS = int(os.getenv("CPU_THREADS", "0")) or max(1, (os.cpu_count() or 2) // 2)
+    OCR_MAX_IMAGE_DIMENSION = 2048  # Longest edge sent to Gemini
+    OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "256"))  # Cached OCR results, 0 disables
+    OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", "5"))  # In-flight Gemini calls (rate limit)
+    OCR_MAX_BATCH_SIZE = int(os.getenv("OCR_MAX_BATCH_SIZE", "20"))  # Images per /ocr-extract-batch request
+    ASK_CACHE_SIZE = int(os.getenv("ASK_CACHE_SIZE", "1024"))  # Cached /ask answers, 0 disables
+    # Cosine similarity at which a new /ask question reuses a cached answer. Off (>1) by default:
+    # MiniLM scores paraphrases with different meanings (child vs adult, negations) above 0.97
+    ASK_CACHE_SIMILARITY = float(os.getenv("ASK_CACHE_SIMILARITY", "1.1"))
+    WHISPER_NUM_BEAMS = int(os.getenv("WHISPER_NUM_BEAMS", "1"))  # 1 = greedy decoding
+    WHISPER_MAX_NEW_TOKENS = int(os.getenv("WHISPER_MAX_NEW_TOKENS", "224"))  # Bounds the decoder loop
+    WHISPER_ATTN_IMPLEMENTATION = os.getenv("WHISPER_ATTN_IMPLEMENTATION", "sdpa")  # or "flash_attention_2"
+    WHISPER_CUDA_DTYPE = os.getenv("WHISPER_CUDA_DTYPE", "float16")  # or "bfloat16" on Ampere+
+    WHISPER_CPU_INT8 = os.getenv("WHISPER_CPU_INT8", "1") == "1"  # Dynamic INT8 Linear layers on CPU
+    WHISPER_CUDA_INT8 = os.getenv("WHISPER_CUDA_INT8", "0") == "1"  # bitsandbytes INT8 weights on GPU
+    WHISPER_TORCH_COMPILE = os.getenv("WHISPER_TORCH_COMPILE", "1") == "1"  # torch.compile the decoder on CUDA
+    WHISPER_WARMUP_RUNS = int(os.getenv("WHISPER_WARMUP_RUNS", "3"))  # Dummy transcriptions at startup (transformers: CUDA only)
+    WHISPER_GPU_FEATURES = os.getenv("WHISPER_GPU_FEATURES", "1") == "1"  # Log-mel on the GPU instead of NumPy
+    WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", "4"))  # Max requests per generate() call
+    WHISPER_BATCH_WAIT_MS = int(os.getenv("WHISPER_BATCH_WAIT_MS", "20"))  # Time to wait for more requests
+    
+    # Server
+    # Each worker loads its own Whisper, so scale out only if memory allows
+    WORKERS = int(os.getenv("WORKERS", "1"))
+    LIMIT_CONCURRENCY = int(os.getenv("LIMIT_CONCURRENCY", "128"))  # 503 beyond this many open connections
+    KEEP_ALIVE_TIMEOUT = int(os.getenv("KEEP_ALIVE_TIMEOUT", "30"))  # Seconds to hold idle HTTP/1.1 connections
+    BLOCKING_THREADS = int(os.getenv("BLOCKING_THREADS", "64"))  # asyncio.to_thread pool (audio decode, OCR, embeddings)
     
     # CORS
     ALLOWED_ORIGINS = [
@@ -119,6 +160,10 @@ class GeminiOCR:
     """Fast prescription OCR using Gemini Vision"""
     
     def __init__(self):
+        # LRU of image hash -> extracted text, so re-submitted scans skip Gemini
+        self._cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
         if not config.GEMINI_API_KEY:
             logger.warning("⚠️ GEMINI_API_KEY not set. OCR will not work.")
             self.model = None
@@ -128,8 +173,10 @@ class GeminiOCR:
         self.model = genai.GenerativeModel(
             model_name=config.GEMINI_MODEL,
             generation_config={
-                "temperature": 0.1,
-                "top_p": 0.95,
+                # Greedy decoding: OCR wants the single most likely transcription,
+                # and identical scans then give identical (cacheable) text
+                "temperature": 0.0,
+                "top_k": 1,
                 "max_output_tokens": 2048,
             },
             safety_settings=[
@@ -140,7 +187,8 @@ class GeminiOCR:
                     "HARM_CATEGORY_SEXUALLY_EXPLICIT",
                     "HARM_CATEGORY_DANGEROUS_CONTENT"
                 ]
-            ]
+            ],
+            system_instruction=PRESCRIPTION_OCR_PROMPT
         )
         logger.info("✅ Gemini OCR initialized")
     
@@ -149,31 +197,22 @@ class GeminiOCR:
         if not self.model:
             raise HTTPException(503, "Gemini OCR not configured. Set GEMINI_API_KEY.")
         
+        cache_key = hashlib.blake2b(image_bytes, digest_size=16).digest()
+        with self._cache_lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+                logger.info("✅ OCR cache hit")
+                return cached
+        
         try:
-            # Preprocess image
-            image = Image.open(io.BytesIO(image_bytes))
-            
-            # Convert to RGB
-            if image.mode not in ('RGB', 'L'):
-                image = image.convert('RGB')
-            
-            # Resize if too large (max 4096px)
-            max_dim = 4096
-            if max(image.size) > max_dim:
-                ratio = max_dim / max(image.size)
-                new_size = tuple(int(d * ratio) for d in image.size)
-                image = image.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # Convert to bytes
-            img_bytes = io.BytesIO()
-            image.save(img_bytes, format='PNG')
-            img_bytes = img_bytes.getvalue()
+            # Pass through or downscale/re-encode (shared with gemini_ocr.py)
+            img_bytes, mime_type = prepare_image_for_gemini(image_bytes, config.OCR_MAX_IMAGE_DIMENSION)
             
             # Call Gemini
-            logger.info("Calling Gemini Vision API...")
+            logger.info(f"Calling Gemini Vision API ({len(img_bytes)} bytes, {mime_type})...")
             response = self.model.generate_content([
-                PRESCRIPTION_OCR_PROMPT,
-                {"mime_type": "image/png", "data": img_bytes}
+                {"mime_type": mime_type, "data": img_bytes}
             ])
             
             if not response or not response.text:
@@ -181,17 +220,86 @@ class GeminiOCR:
             
             text = response.text.strip()
             logger.info(f"✅ Extracted {len(text)} characters")
-            return text
             
         except Exception as e:
             logger.error(f"Gemini OCR failed: {e}")
             raise HTTPException(500, f"OCR failed: {str(e)}")
+        
+        if config.OCR_CACHE_SIZE > 0:
+            with self._cache_lock:
+                self._cache[cache_key] = text
+                if len(self._cache) > config.OCR_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return text
 
 # ============================================================================
 # REAL RAG SYSTEM - Now using RAGPrescriptionGenerator
 # ============================================================================
 # The real RAG system is imported from rag_prescription_generator.py
-# It uses Chroma vector store, LangChain, and Ollama LLM for true RAG
+# It uses in-memory embedding search, LangChain, and Ollama LLM for true RAG
+
+# ============================================================================
+# AUDIO DECODING
+# ============================================================================
+
+# Whisper expects 16 kHz mono input
+SAMPLE_RATE = 16000
+
+def decode_with_av(audio_file: BinaryIO) -> np.ndarray:
+    """Decode any ffmpeg-supported container to 16 kHz mono float32 without a subprocess"""
+    max_samples = config.MAX_AUDIO_LENGTH * SAMPLE_RATE
+    resampler = av.AudioResampler(format='flt', layout='mono', rate=SAMPLE_RATE)
+    chunks = []
+    decoded = 0
+    
+    with av.open(audio_file) as container:
+        for frame in container.decode(audio=0):
+            for out in resampler.resample(frame):
+                chunk = out.to_ndarray().ravel()
+                chunks.append(chunk)
+                decoded += len(chunk)
+            # Stop decoding once MAX_AUDIO_LENGTH is covered
+            if decoded >= max_samples:
+                break
+        else:
+            chunks.extend(out.to_ndarray().ravel() for out in resampler.resample(None))
+    
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks)[:max_samples]
+
+def resample_audio(speech: np.ndarray, orig_sr: int) -> np.ndarray:
+    """Resample a mono float32 waveform to 16 kHz with PyAV's libswresample"""
+    resampler = av.AudioResampler(format='flt', layout='mono', rate=SAMPLE_RATE)
+    frame = av.AudioFrame.from_ndarray(
+        np.ascontiguousarray(speech, dtype=np.float32)[np.newaxis, :], format='flt', layout='mono'
+    )
+    frame.sample_rate = orig_sr
+    
+    chunks = [out.to_ndarray().ravel() for out in resampler.resample(frame)]
+    chunks.extend(out.to_ndarray().ravel() for out in resampler.resample(None))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks)
+
+def load_audio(audio: Union[bytes, BinaryIO]) -> np.ndarray:
+    """Decode audio bytes or a seekable file to 16 kHz mono float32, truncated to MAX_AUDIO_LENGTH"""
+    audio_file = io.BytesIO(audio) if isinstance(audio, bytes) else audio
+    try:
+        # Single in-process decode via libsndfile (WAV, FLAC, OGG)
+        speech, sr = sf.read(audio_file, dtype='float32', always_2d=False)
+    except sf.LibsndfileError:
+        # Containers libsndfile can't read (webm, m4a, mp3) are decoded in-process by PyAV
+        audio_file.seek(0)
+        return decode_with_av(audio_file)
+    
+    if speech.ndim > 1:
+        speech = speech.mean(axis=1)
+    
+    speech = speech[:config.MAX_AUDIO_LENGTH * sr]
+    if sr != SAMPLE_RATE:
+        speech = resample_audio(speech, sr)
+    return speech
 
 # ============================================================================
 # OPTIMIZED WHISPER
@@ -203,10 +311,41 @@ class OptimizedWhisperProcessor:
     def __init__(self):
         logger.info(f"Loading Whisper on {config.DEVICE}...")
         
+        if config.DEVICE == "cuda":
+            # Allow TF32 tensor cores for any remaining fp32 matmuls
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
+            # Mel input is always 3000 frames, so let cuDNN autotune the encoder convs once
+            torch.backends.cudnn.benchmark = True
+        
+        # Load weights directly in half precision on GPU, with fused SDPA attention kernels
+        if config.DEVICE == "cuda":
+            dtype = getattr(torch, config.WHISPER_CUDA_DTYPE)
+            if dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+                logger.warning("BF16 not supported on this GPU, using FP16")
+                dtype = torch.float16
+        else:
+            dtype = torch.float32
+        self.cuda_int8 = config.DEVICE == "cuda" and config.WHISPER_CUDA_INT8
         self.processor = WhisperProcessor.from_pretrained(config.WHISPER_MODEL)
-        self.model = WhisperForConditionalGeneration.from_pretrained(
-            config.WHISPER_MODEL
-        ).to(config.DEVICE)
+        if self.cuda_int8:
+            # INT8 weight-only Linear layers quarter the weight traffic; the rest stays half precision
+            self.model = WhisperForConditionalGeneration.from_pretrained(
+                config.WHISPER_MODEL,
+                torch_dtype=dtype,
+                attn_implementation=config.WHISPER_ATTN_IMPLEMENTATION,
+                quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                device_map=config.DEVICE
+            )
+            logger.info("✅ Loaded bitsandbytes INT8 weights")
+        else:
+            self.model = WhisperForConditionalGeneration.from_pretrained(
+                config.WHISPER_MODEL,
+                torch_dtype=dtype,
+                attn_implementation=config.WHISPER_ATTN_IMPLEMENTATION,
+                # Materialize weights straight from the checkpoint instead of random-init + copy
+                low_cpu_mem_usage=True
+            ).to(config.DEVICE)
         
         # Configure tokenizer to handle pad/eos tokens properly
         # Whisper's tokenizer uses pad_token_id = eos_token_id by design
@@ -216,86 +355,377 @@ class OptimizedWhisperProcessor:
             # Set pad_token_id to eos_token_id (Whisper's default behavior)
             tokenizer.pad_token_id = tokenizer.eos_token_id
         
-        if config.DEVICE == "cuda":
-            self.model = self.model.half()
-            logger.info("✅ Enabled FP16")
+        # Decoding settings never change between requests, so set them once.
+        # Language/task on the generation config let Whisper build its decoder
+        # prompt natively; the checkpoint's forced_decoder_ids would conflict.
+        generation_config = self.model.generation_config
+        generation_config.language = "en"
+        generation_config.task = "transcribe"
+        generation_config.forced_decoder_ids = None
+        self.model.config.forced_decoder_ids = None
+        generation_config.update(
+            max_new_tokens=config.WHISPER_MAX_NEW_TOKENS,
+            num_beams=config.WHISPER_NUM_BEAMS,
+            do_sample=False,
+            use_cache=True,
+        )
+        if config.WHISPER_NUM_BEAMS > 1:
+            generation_config.early_stopping = True  # Stop beams after EOS token
         
         self.model.eval()
-        logger.info(f"✅ Whisper loaded")
-    
-    @torch.no_grad()
-    def transcribe(self, audio_bytes: bytes) -> str:
-        """Transcribe audio"""
-        audio_io = io.BytesIO(audio_bytes)
-        audio_segment = AudioSegment.from_file(audio_io)
-        audio_segment = audio_segment.set_channels(1).set_frame_rate(16000)
         
-        max_ms = config.MAX_AUDIO_LENGTH * 1000
-        if len(audio_segment) > max_ms:
-            audio_segment = audio_segment[:max_ms]
+        if config.DEVICE == "cpu" and config.WHISPER_CPU_INT8:
+            # INT8 weights + FBGEMM GEMMs for the Linear layers; activations stay FP32
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model,
+                {torch.nn.Linear},
+                dtype=torch.qint8
+            )
+            logger.info("✅ Enabled dynamic INT8 quantization")
+        
+        # bitsandbytes kernels don't trace under torch.compile
+        if config.DEVICE == "cuda" and config.WHISPER_TORCH_COMPILE and not self.cuda_int8:
+            # A static KV cache keeps decoder shapes fixed, so CUDA graphs are
+            # captured once per batch size instead of recompiling every token
+            generation_config.cache_implementation = "static"
+            self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead")
+            logger.info("✅ Enabled torch.compile (first requests warm up the graphs)")
         
-        wav_io = io.BytesIO()
-        audio_segment.export(wav_io, format="wav")
-        wav_io.seek(0)
+        self._mel_filters = None
+        if config.DEVICE == "cuda" and config.WHISPER_GPU_FEATURES:
+            # Whisper's own mel filterbank and Hann window, kept on the device
+            feature_extractor = self.processor.feature_extractor
+            self._mel_filters = torch.from_numpy(feature_extractor.mel_filters).to(config.DEVICE, torch.float32).T
+            self._mel_window = torch.hann_window(feature_extractor.n_fft, device=config.DEVICE)
+            # Reused page-locked staging buffer so waveform uploads are true async DMA copies
+            self._pinned_waveforms = torch.zeros(
+                config.WHISPER_BATCH_SIZE, feature_extractor.n_samples, pin_memory=True
+            )
         
-        speech, sr = librosa.load(wav_io, sr=16000, mono=True)
+        if config.DEVICE == "cuda" and config.WHISPER_WARMUP_RUNS > 0:
+            self._warmup()
         
-        if len(speech) == 0:
-            raise ValueError("Empty audio")
+        logger.info(f"✅ Whisper loaded ({self.model.dtype}, {config.WHISPER_ATTN_IMPLEMENTATION} attention)")
+    
+    def _warmup(self):
+        """Run silent clips through generate() so the first request skips cuBLAS/cuDNN
+        autotuning and torch.compile's CUDA graph capture"""
+        silence = np.zeros(SAMPLE_RATE, dtype=np.float32)
+        # The static KV cache is sized per batch, so compiled graphs are too;
+        # warm every size WhisperBatcher can send to avoid recompiles mid-traffic
+        batch_sizes = range(1, config.WHISPER_BATCH_SIZE + 1) if config.WHISPER_TORCH_COMPILE and not self.cuda_int8 else [1]
+        for batch_size in batch_sizes:
+            for _ in range(config.WHISPER_WARMUP_RUNS):
+                self.transcribe_batch([silence] * batch_size)
+        torch.cuda.synchronize()
+        logger.info(f"✅ Warmed up Whisper ({config.WHISPER_WARMUP_RUNS} runs x {len(batch_sizes)} batch sizes)")
+    
+    def _log_mel_on_device(self, speeches: List[np.ndarray]) -> torch.Tensor:
+        """Whisper's log-mel features computed with torch.stft on the model's device.
+        Mirrors WhisperFeatureExtractor so the encoder sees identical inputs."""
+        feature_extractor = self.processor.feature_extractor
+        n_samples = feature_extractor.n_samples
         
-        # Process audio to mel spectrogram features
-        # Note: WhisperProcessor returns input_features (mel spectrograms), not tokens
-        # There's no attention_mask for audio inputs - this is normal for Whisper
-        processed = self.processor(
-            speech,
-            sampling_rate=sr,
-            return_tensors="pt"
-        )
-        input_features = processed.input_features.to(config.DEVICE)
+        # Pad/truncate every clip to 30 s, as the feature extractor does. Batches
+        # run one at a time, so the staging buffer is free once generate() returns
+        if len(speeches) > len(self._pinned_waveforms):
+            self._pinned_waveforms = torch.zeros(len(speeches), n_samples, pin_memory=True)
+        host_waveforms = self._pinned_waveforms[:len(speeches)]
+        host_waveforms.zero_()
+        for i, speech in enumerate(speeches):
+            speech = speech[:n_samples]
+            host_waveforms[i, :len(speech)] = torch.from_numpy(speech)
+        waveforms = host_waveforms.to(config.DEVICE, non_blocking=True)
         
-        # Get decoder prompt IDs for language and task
-        forced_decoder_ids = self.processor.get_decoder_prompt_ids(
-            language="english",
-            task="transcribe"
+        stft = torch.stft(
+            waveforms,
+            feature_extractor.n_fft,
+            feature_extractor.hop_length,
+            window=self._mel_window,
+            return_complex=True
         )
+        magnitudes = stft[..., :-1].abs() ** 2
+        
+        log_spec = torch.clamp(self._mel_filters @ magnitudes, min=1e-10).log10()
+        max_val = log_spec.amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, max_val - 8.0)
+        log_spec = (log_spec + 4.0) / 4.0
+        return log_spec.to(self.model.dtype)
+    
+    @torch.inference_mode()
+    def transcribe_batch(self, speeches: List[np.ndarray]) -> List[str]:
+        """Transcribe decoded 16 kHz waveforms in a single generate() call"""
+        if self._mel_filters is not None:
+            # STFT + mel filterbank on the GPU; only the raw waveform is copied over
+            input_features = self._log_mel_on_device(speeches)
+        else:
+            # Process audio to mel spectrogram features
+            # Note: WhisperProcessor returns input_features (mel spectrograms), not tokens
+            # Every clip is padded to 30s of features, so a batch stacks without masks
+            processed = self.processor(
+                speeches,
+                sampling_rate=SAMPLE_RATE,
+                return_tensors="pt",
+                return_attention_mask=False
+            )
+            input_features = processed.input_features.to(config.DEVICE, dtype=self.model.dtype)
         
         # Generate transcription
         # Note: Whisper models intentionally use pad_token_id = eos_token_id
-        # This is by design and the warning is harmless for single-audio transcription
+        # This is by design and the warning is harmless here
         # The warning occurs in the decoder (text generation), not the encoder (audio processing)
         
         # Suppress the harmless attention mask warning to keep logs clean
-        # This warning doesn't affect transcription quality for single audio files
+        # All decoder prompts have the same length, so it doesn't affect quality
         with warnings.catch_warnings():
             warnings.filterwarnings(
                 "ignore",
                 message=".*attention mask.*pad token.*eos token.*",
             )
             
-            predicted_ids = self.model.generate(
-                input_features,
-                forced_decoder_ids=forced_decoder_ids,
-                max_length=225,
-                num_beams=5,
-                early_stopping=True,  # Stop generation after EOS token
-            )
+            predicted_ids = self.model.generate(input_features)
+        
+        transcriptions = [
+            text.strip()
+            for text in self.processor.batch_decode(predicted_ids, skip_special_tokens=True)
+        ]
+        
+        for transcription in transcriptions:
+            logger.info(f"Transcribed: '{transcription[:50]}...'")
+        return transcriptions
+
+class FasterWhisperProcessor:
+    """CTranslate2 Whisper (faster-whisper) with INT8 weights"""
+    
+    # model.transcribe() defaults that decide temperature fallback and silence
+    COMPRESSION_RATIO_THRESHOLD = 2.4
+    LOG_PROB_THRESHOLD = -1.0
+    NO_SPEECH_THRESHOLD = 0.6
+    
+    def __init__(self):
+        from faster_whisper import WhisperModel
+        from faster_whisper.audio import pad_or_trim
+        from faster_whisper.tokenizer import Tokenizer
+        from faster_whisper.transcribe import get_compression_ratio, get_suppressed_tokens
+        from faster_whisper.vad import VadOptions, collect_chunks, get_speech_timestamps
+        
+        compute_type = config.FASTER_WHISPER_COMPUTE_TYPE or (
+            "int8_float16" if config.DEVICE == "cuda" else "int8"
+        )
+        logger.info(f"Loading faster-whisper '{config.FASTER_WHISPER_MODEL}' on {config.DEVICE} ({compute_type})...")
+        
+        self.model = WhisperModel(
+            config.FASTER_WHISPER_MODEL,
+            device=config.DEVICE,
+            compute_type=compute_type,
+            cpu_threads=config.CPU_THREADS
+        )
+        
+        # Fixed English/transcribe prompt for batched CTranslate2 generate()
+        self._pad_or_trim = pad_or_trim
+        self._compression_ratio = get_compression_ratio
+        self._tokenizer = Tokenizer(
+            self.model.hf_tokenizer,
+            self.model.model.is_multilingual,
+            task="transcribe",
+            language="en"
+        )
+        self._prompt = self.model.get_prompt(self._tokenizer, previous_tokens=[], without_timestamps=True)
+        # Same suppression and VAD settings model.transcribe() uses by default
+        self._suppress_tokens = list(get_suppressed_tokens(self._tokenizer, [-1]))
+        self._vad_options = VadOptions()
+        self._speech_timestamps = get_speech_timestamps
+        self._collect_chunks = collect_chunks
+        
+        if config.WHISPER_WARMUP_RUNS > 0:
+            self._warmup()
+        logger.info(f"✅ faster-whisper loaded")
+    
+    def _warmup(self):
+        """Run silent and batched clips so the first request skips lazy setup:
+        the VAD model load and CUDA/cuBLAS init for encode/generate"""
+        silence = np.zeros(SAMPLE_RATE, dtype=np.float32)
+        for _ in range(config.WHISPER_WARMUP_RUNS):
+            # VAD drops pure silence, so decode it directly to reach encode/generate
+            self._vad_trim(silence)
+            self._generate([silence])
+            self._generate([silence, silence])
+        logger.info(f"✅ Warmed up faster-whisper ({config.WHISPER_WARMUP_RUNS} runs)")
+    
+    def _vad_trim(self, speech: np.ndarray) -> np.ndarray:
+        """Keep only the voiced parts of a clip, as transcribe(vad_filter=True) does"""
+        speech_chunks = self._speech_timestamps(speech, self._vad_options)
+        audio_chunks, _ = self._collect_chunks(speech, speech_chunks)
+        return np.concatenate(audio_chunks, axis=0)
+    
+    def _generate(self, speeches: List[np.ndarray]) -> list:
+        """Temperature-0 decode with transcribe()'s options, batched over clips"""
+        features = np.stack([
+            self._pad_or_trim(self.model.feature_extractor(speech)[..., :-1])
+            for speech in speeches
+        ])
+        encoder_output = self.model.encode(features)
+        return self.model.model.generate(
+            encoder_output,
+            [list(self._prompt) for _ in speeches],
+            beam_size=config.WHISPER_NUM_BEAMS,
+            patience=1,
+            length_penalty=1,
+            max_length=min(len(self._prompt) + config.WHISPER_MAX_NEW_TOKENS, self.model.max_length),
+            return_scores=True,
+            return_no_speech_prob=True,
+            suppress_blank=True,
+            suppress_tokens=self._suppress_tokens,
+            max_initial_timestamp_index=int(round(1.0 / self.model.time_precision))
+        )
+    
+    def transcribe_batch(self, speeches: List[np.ndarray]) -> List[str]:
+        """Transcribe decoded 16 kHz waveforms, batching the encoder and decoder.
+        
+        Every batch size takes the same path so a clip's transcript doesn't depend
+        on what it was batched with: VAD trim, one greedy/beam pass at temperature 0
+        for the whole batch, and clips that fail transcribe()'s quality thresholds
+        are re-run alone through transcribe() for its temperature fallback.
+        """
+        transcriptions = [""] * len(speeches)
+        voiced = [self._vad_trim(speech) for speech in speeches]
+        indices = [i for i, speech in enumerate(voiced) if len(speech)]
         
-        transcription = self.processor.batch_decode(
-            predicted_ids,
-            skip_special_tokens=True
-        )[0].strip()
+        if indices:
+            # Every clip fits one 30 s window, so stack padded features and run
+            # a single CTranslate2 encode + generate for the whole batch
+            results = self._generate([voiced[i] for i in indices])
+            for i, result in zip(indices, results):
+                tokens = result.sequences_ids[0]
+                avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+                text = self._tokenizer.decode(tokens).strip()
+                
+                if result.no_speech_prob > self.NO_SPEECH_THRESHOLD and avg_logprob < self.LOG_PROB_THRESHOLD:
+                    # transcribe() drops segments it judges to be silence
+                    continue
+                if (self._compression_ratio(text) > self.COMPRESSION_RATIO_THRESHOLD
+                        or avg_logprob < self.LOG_PROB_THRESHOLD):
+                    text = self._transcribe_speech(speeches[i])
+                transcriptions[i] = text
         
-        logger.info(f"Transcribed: '{transcription[:50]}...'")
-        return transcription
+        for transcription in transcriptions:
+            logger.info(f"Transcribed: '{transcription[:50]}...'")
+        return transcriptions
+    
+    def _transcribe_speech(self, speech: np.ndarray) -> str:
+        # Segments are generated lazily; joining them runs the decode
+        segments, _ = self.model.transcribe(
+            speech,
+            language="en",
+            task="transcribe",
+            beam_size=config.WHISPER_NUM_BEAMS,
+            vad_filter=True,
+            # Clips are capped at MAX_AUDIO_LENGTH (one 30 s window), so skip
+            # timestamp tokens and cross-window prompting
+            without_timestamps=True,
+            condition_on_previous_text=False,
+            max_new_tokens=config.WHISPER_MAX_NEW_TOKENS
+        )
+        return " ".join(segment.text.strip() for segment in segments).strip()
+
+def load_whisper() -> Union[FasterWhisperProcessor, OptimizedWhisperProcessor]:
+    """Load the configured Whisper backend, falling back to transformers"""
+    if config.WHISPER_BACKEND == "faster-whisper":
+        try:
+            return FasterWhisperProcessor()
+        except ImportError:
+            logger.warning("⚠️ faster-whisper not installed. Falling back to transformers Whisper.")
+    return OptimizedWhisperProcessor()
+
+class WhisperBatcher:
+    """
+    Micro-batches concurrent transcription requests.
+    
+    Requests arriving within WHISPER_BATCH_WAIT_MS of each other are
+    transcribed together (up to WHISPER_BATCH_SIZE) on the processor's
+    dedicated executor, so the event loop stays free while Whisper runs.
+    """
+    
+    def __init__(self, processor, executor: ThreadPoolExecutor, max_batch_size: int, max_wait_ms: int):
+        self.processor = processor
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+    
+    async def transcribe(self, audio: Union[bytes, BinaryIO]) -> str:
+        """Decode audio and wait for its slot in the next batch"""
+        speech = await asyncio.to_thread(load_audio, audio)
+        
+        if len(speech) == 0:
+            raise ValueError("Empty audio")
+        
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((speech, future))
+        return await future
+    
+    async def _collect_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            speeches = [speech for speech, _ in batch]
+            
+            try:
+                transcriptions = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.processor.transcribe_batch, speeches
+                )
+            except Exception as e:
+                logger.error(f"Batched transcription failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            if len(batch) > 1:
+                logger.info(f"Transcribed batch of {len(batch)} requests")
+            for (_, future), transcription in zip(batch, transcriptions):
+                if not future.done():
+                    future.set_result(transcription)
 
 # ============================================================================
 # GLOBAL INSTANCES
 # ============================================================================
 
 # Global instances (initialized in lifespan)
-whisper: Optional[OptimizedWhisperProcessor] = None
+whisper: Optional[Union[FasterWhisperProcessor, OptimizedWhisperProcessor]] = None
+whisper_batcher: Optional[WhisperBatcher] = None
 rag: Optional[RAGPrescriptionGenerator] = None
 gemini_ocr: Optional[GeminiOCR] = None
+ocr_semaphore = asyncio.Semaphore(config.OCR_MAX_CONCURRENCY)
+# Whisper loads, warms up and transcribes on this one thread: compiled CUDA
+# graphs are recorded per thread, so a shared pool would re-record them
+whisper_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+# Only touched from the event loop, so it needs no lock
+ask_cache: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
 
 # ============================================================================
 # LIFESPAN EVENT HANDLER (Modern FastAPI approach)
@@ -310,7 +740,7 @@ async def lifespan(app: FastAPI):
     - Code before 'yield' runs at startup
     - Code after 'yield' runs at shutdown
     """
-    global whisper, rag, gemini_ocr
+    global whisper, whisper_batcher, rag, gemini_ocr
     
     # ==================== STARTUP LOGIC ====================
     logger.info("=" * 60)
@@ -319,20 +749,41 @@ async def lifespan(app: FastAPI):
     logger.info(f"Gemini API: {'✅ Configured' if config.GEMINI_API_KEY else '❌ Not set'}")
     logger.info("=" * 60)
     
+    if config.DEVICE == "cpu":
+        # Cap torch's OpenMP pool so inference doesn't starve uvicorn of cores
+        torch.set_num_threads(config.CPU_THREADS)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # Can only be set before any inter-op work has started
+            pass
+        logger.info(f"Torch CPU threads: {config.CPU_THREADS}")
+    
+    # Blocking steps other than Whisper (audio decode, Gemini, embeddings) run via
+    # asyncio.to_thread; size its pool for LIMIT_CONCURRENCY rather than the CPU count
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=config.BLOCKING_THREADS, thread_name_prefix="blocking")
+    )
+    
     try:
-        # Initialize Whisper
-        logger.info("Loading Whisper...")
-        whisper = OptimizedWhisperProcessor()
+        # Whisper, the RAG embedder and Gemini load independently; their
+        # downloads and disk reads release the GIL, so overlap them in threads
+        logger.info("Loading Whisper, Real RAG System (embedding search + LangChain + Ollama) and Gemini OCR...")
+        whisper, rag, gemini_ocr = await asyncio.gather(
+            asyncio.get_running_loop().run_in_executor(whisper_executor, load_whisper),
+            asyncio.to_thread(RAGPrescriptionGenerator, data_path=config.KNOWLEDGE_BASE_PATH),
+            asyncio.to_thread(GeminiOCR),
+        )
         logger.info("✅ Whisper loaded")
-        
-        # Initialize REAL RAG system with Chroma, LangChain, and Ollama
-        logger.info("Initializing Real RAG System (Chroma + LangChain + Ollama)...")
-        rag = RAGPrescriptionGenerator(data_path=config.KNOWLEDGE_BASE_PATH)
         logger.info("✅ Real RAG System initialized")
         
-        # Initialize Gemini OCR
-        logger.info("Initializing Gemini OCR...")
-        gemini_ocr = GeminiOCR()
+        whisper_batcher = WhisperBatcher(
+            whisper,
+            whisper_executor,
+            max_batch_size=config.WHISPER_BATCH_SIZE,
+            max_wait_ms=config.WHISPER_BATCH_WAIT_MS
+        )
+        whisper_batcher.start()
         logger.info("✅ All services ready!")
         
     except Exception as e:
@@ -346,6 +797,9 @@ async def lifespan(app: FastAPI):
     # ==================== SHUTDOWN LOGIC ====================
     # Optional cleanup code goes here
     logger.info("Shutting down Medical AI Service...")
+    if whisper_batcher:
+        await whisper_batcher.stop()
+    whisper_executor.shutdown(wait=False)
     # Add any cleanup logic here if needed
     # For example: close database connections, cleanup resources, etc.
     logger.info("✅ Service shutdown complete")
@@ -357,7 +811,8 @@ async def lifespan(app: FastAPI):
 app = FastAPI(
     title="Medical AI Service with Gemini OCR",
     version="5.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -368,6 +823,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class NonStreamingGZipMiddleware(GZipMiddleware):
+    """GZip responses except Server-Sent Events, which gzip would buffer until the end.
+    Decided per response from its content type, so any SSE route is covered."""
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        event_stream = False
+        
+        async def route(scope, receive, gzip_send):
+            async def route_send(message):
+                nonlocal event_stream
+                if message["type"] == "http.response.start":
+                    content_type = Headers(raw=message["headers"]).get("content-type", "")
+                    event_stream = content_type.startswith("text/event-stream")
+                # SSE goes straight to the client; gzip never sees it
+                await (send if event_stream else gzip_send)(message)
+            await self.app(scope, receive, route_send)
+        
+        await GZipMiddleware(route, self.minimum_size, self.compresslevel)(scope, receive, send)
+
+app.add_middleware(NonStreamingGZipMiddleware, minimum_size=1024)
+
 # ============================================================================
 # REQUEST MODELS
 # ============================================================================
@@ -381,6 +861,16 @@ class OCRResponse(BaseModel):
     confidence: str
     characters_extracted: int
 
+class OCRBatchItem(BaseModel):
+    filename: Optional[str] = None
+    text: Optional[str] = None
+    characters_extracted: int = 0
+    error: Optional[str] = None
+
+class OCRBatchResponse(BaseModel):
+    results: List[OCRBatchItem]
+    model: str
+
 @app.get("/health")
 def health_check():
     """Health check"""
@@ -388,12 +878,33 @@ def health_check():
         "status": "healthy",
         "device": config.DEVICE,
         "gemini_ocr": "available" if gemini_ocr and gemini_ocr.model else "not configured",
-        "whisper_model": config.WHISPER_MODEL,
-        "rag_system": "Real RAG (Chroma + LangChain + Ollama)" if rag else "not initialized",
+        "whisper_backend": type(whisper).__name__ if whisper else "not initialized",
+        "whisper_model": config.FASTER_WHISPER_MODEL if isinstance(whisper, FasterWhisperProcessor) else config.WHISPER_MODEL,
+        "rag_system": "Real RAG (embedding search + LangChain + Ollama)" if rag else "not initialized",
         "ollama_model": rag.model_name if rag else "not configured",
         "conditions_loaded": len(rag._raw_kb) if rag else 0
     }
 
+async def read_ocr_image(image: UploadFile) -> bytes:
+    """Validate an uploaded prescription image and return its bytes"""
+    if not image.content_type or not image.content_type.startswith('image/'):
+        raise HTTPException(400, "File must be an image")
+    
+    image_bytes = await image.read()
+    
+    if len(image_bytes) > 20 * 1024 * 1024:
+        raise HTTPException(400, "Image too large (max 20MB)")
+    
+    if len(image_bytes) == 0:
+        raise HTTPException(400, "Empty image")
+    
+    return image_bytes
+
+async def run_ocr(image_bytes: bytes) -> str:
+    """Run Gemini OCR in a worker thread, bounded by the OCR semaphore"""
+    async with ocr_semaphore:
+        return await asyncio.to_thread(gemini_ocr.extract_text, image_bytes)
+
 @app.post("/ocr-extract")
 async def ocr_extract_text(image: UploadFile = File(...)) -> OCRResponse:
     """
@@ -412,21 +923,12 @@ async def ocr_extract_text(image: UploadFile = File(...)) -> OCRResponse:
     
     try:
         # Validate file
-        if not image.content_type or not image.content_type.startswith('image/'):
-            raise HTTPException(400, "File must be an image")
-        
-        image_bytes = await image.read()
-        
-        if len(image_bytes) > 20 * 1024 * 1024:
-            raise HTTPException(400, "Image too large (max 20MB)")
-        
-        if len(image_bytes) == 0:
-            raise HTTPException(400, "Empty image")
+        image_bytes = await read_ocr_image(image)
         
         logger.info(f"Processing image: {image.filename}")
         
         # Extract text
-        extracted_text = gemini_ocr.extract_text(image_bytes)
+        extracted_text = await run_ocr(image_bytes)
         
         if len(extracted_text.strip()) < 10:
             raise HTTPException(400, "No text detected in image")
@@ -444,6 +946,46 @@ async def ocr_extract_text(image: UploadFile = File(...)) -> OCRResponse:
         logger.error(f"OCR failed: {e}", exc_info=True)
         raise HTTPException(500, f"OCR failed: {str(e)}")
 
+@app.post("/ocr-extract-batch")
+async def ocr_extract_batch(images: List[UploadFile] = File(...)) -> OCRBatchResponse:
+    """
+    Extract text from several prescription images concurrently
+    
+    Images are processed in parallel (up to OCR_MAX_CONCURRENCY Gemini calls
+    at once). A failing image is reported in its own result and does not
+    fail the whole batch.
+    """
+    
+    if not gemini_ocr or not gemini_ocr.model:
+        raise HTTPException(
+            503,
+            "Gemini OCR not configured. Set GEMINI_API_KEY environment variable."
+        )
+    
+    if len(images) > config.OCR_MAX_BATCH_SIZE:
+        raise HTTPException(400, f"Too many images (max {config.OCR_MAX_BATCH_SIZE})")
+    
+    async def process(image: UploadFile) -> OCRBatchItem:
+        try:
+            extracted_text = await run_ocr(await read_ocr_image(image))
+            if len(extracted_text.strip()) < 10:
+                raise HTTPException(400, "No text detected in image")
+            return OCRBatchItem(
+                filename=image.filename,
+                text=extracted_text,
+                characters_extracted=len(extracted_text)
+            )
+        except HTTPException as e:
+            return OCRBatchItem(filename=image.filename, error=str(e.detail))
+        except Exception as e:
+            logger.error(f"OCR failed for {image.filename}: {e}", exc_info=True)
+            return OCRBatchItem(filename=image.filename, error=f"OCR failed: {str(e)}")
+    
+    logger.info(f"Processing {len(images)} images")
+    results = await asyncio.gather(*(process(image) for image in images))
+    
+    return OCRBatchResponse(results=results, model="gemini-2.5-flash")
+
 @app.post("/generate-prescription")
 async def generate_prescription(
     audio: UploadFile = File(...),
@@ -455,17 +997,18 @@ async def generate_prescription(
     
     This endpoint uses the REAL RAG system which:
     1. Transcribes audio using Whisper
-    2. Retrieves relevant medical context using Chroma vector store
+    2. Retrieves relevant medical context by embedding similarity
     3. Generates structured prescription using Ollama LLM
     4. Returns dynamically generated medication details
     """
     
     try:
-        audio_bytes = await audio.read()
         logger.info(f"Processing audio: {audio.filename}")
         
         # Step 1: Transcribe audio
-        transcription = whisper.transcribe(audio_bytes)
+        # Decode straight from the spooled upload instead of copying it into bytes
+        await audio.seek(0)
+        transcription = await whisper_batcher.transcribe(audio.file)
         
         if not transcription:
             raise HTTPException(400, "No speech detected")
@@ -473,8 +1016,8 @@ async def generate_prescription(
         logger.info(f"Transcription: '{transcription}'")
         
         # Step 2: Use REAL RAG system to generate prescription
-        # This uses Chroma retrieval + Ollama LLM generation
-        prescription_data = rag.generate(transcription)
+        # This uses embedding retrieval + Ollama LLM generation
+        prescription_data = await rag.agenerate(transcription)
         
         # Handle error responses from RAG system
         if "error" in prescription_data:
@@ -503,47 +1046,194 @@ async def generate_prescription(
         logger.error(f"Error: {e}", exc_info=True)
         raise HTTPException(500, str(e))
 
+def normalize_question(question: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace for the /ask cache key"""
+    question = re.sub(r"[^\w\s]", " ", question.lower())
+    return " ".join(question.split())
+
+ASK_FALLBACK_ANSWER = "I couldn't find relevant information. Please consult a healthcare professional."
+
+def format_ask_intro(condition: str, advice: str) -> str:
+    return f"Based on your query, this appears to be related to {condition}. {advice}"
+
+def format_ask_medications(medications: List[Dict]) -> str:
+    if not medications:
+        return ""
+    med_names = [med.get("name", "Unknown") for med in medications]
+    return f"\n\nSuggested medications: {', '.join(med_names)}"
+
+class AskEmbeddingIndex:
+    """
+    Embeddings of the cached /ask questions in a preallocated (capacity, d) matrix.
+    
+    Rows are recycled as answers are evicted, so a near-duplicate lookup is a
+    single matrix-vector product instead of restacking the cache per request.
+    """
+    
+    def __init__(self, capacity: int):
+        self.capacity = max(0, capacity)
+        self.matrix: Optional[np.ndarray] = None
+        self.row_keys: List[Optional[str]] = [None] * self.capacity
+        self.rows: Dict[str, int] = {}
+        self.free_rows = list(range(self.capacity - 1, -1, -1))
+    
+    def add(self, key: str, embedding: np.ndarray):
+        if self.matrix is None:
+            self.matrix = np.zeros((self.capacity, len(embedding)), dtype=np.float32)
+        row = self.rows.get(key)
+        if row is None:
+            if not self.free_rows:
+                return
+            row = self.free_rows.pop()
+            self.rows[key] = row
+            self.row_keys[row] = key
+        self.matrix[row] = embedding
+    
+    def remove(self, key: str):
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.matrix[row] = 0.0
+            self.row_keys[row] = None
+            self.free_rows.append(row)
+    
+    def search(self, embedding: np.ndarray, threshold: float) -> Optional[str]:
+        """Key of the most similar cached question, if its cosine similarity reaches threshold"""
+        if not self.rows:
+            return None
+        sims = self.matrix @ embedding
+        best = int(np.argmax(sims))
+        key = self.row_keys[best]
+        return key if key is not None and sims[best] >= threshold else None
+
+ask_cache_index = AskEmbeddingIndex(config.ASK_CACHE_SIZE)
+
+async def find_cached_answer(question: str):
+    """Look up /ask's cache for a question: exact normalized text first, then a
+    near-duplicate by embedding. Returns (cache_key, embedding, cached answer);
+    the embedding is None when semantic matching is disabled."""
+    cache_key = normalize_question(question)
+    cached = ask_cache.get(cache_key)
+    if cached is not None:
+        ask_cache.move_to_end(cache_key)
+        return cache_key, None, cached
+    
+    embedding = None
+    if config.ASK_CACHE_SIZE > 0 and config.ASK_CACHE_SIMILARITY <= 1.0:
+        embedding = await asyncio.to_thread(rag.embed_query, question)
+        similar_key = ask_cache_index.search(embedding, config.ASK_CACHE_SIMILARITY)
+        if similar_key is not None:
+            ask_cache.move_to_end(similar_key)
+            return cache_key, embedding, ask_cache[similar_key]
+    return cache_key, embedding, None
+
+def store_ask_answer(cache_key: str, embedding: Optional[np.ndarray], response: Dict[str, str]):
+    ask_cache[cache_key] = response
+    if len(ask_cache) > config.ASK_CACHE_SIZE:
+        evicted, _ = ask_cache.popitem(last=False)
+        ask_cache_index.remove(evicted)
+    if embedding is not None:
+        ask_cache_index.add(cache_key, embedding)
+
 @app.post("/ask")
 async def ask_question(payload: AskPayload):
     """
     Simple Q&A using Real RAG System
     
     This endpoint uses the REAL RAG system to answer medical questions:
-    1. Retrieves relevant context from Chroma vector store
+    1. Retrieves relevant context by embedding similarity
     2. Uses Ollama LLM to generate intelligent responses
     3. Returns contextual medical advice
+    
+    Answers are cached by normalized question text. Setting ASK_CACHE_SIMILARITY
+    to 1.0 or below also lets near-duplicate questions reuse a cached answer.
     """
     
     try:
+        cache_key, embedding, cached = await find_cached_answer(payload.question)
+        if cached is not None:
+            return cached
+
         # Use REAL RAG system to generate response
-        result = rag.generate(payload.question)
+        result = await rag.agenerate(payload.question, query_embedding=embedding)
         
         if "error" in result:
-            content = result.get("general_advice", "I couldn't find relevant information. Please consult a healthcare professional.")
+            content = ASK_FALLBACK_ANSWER
         else:
-            condition = result.get("condition", "your condition")
-            advice = result.get("general_advice", "")
-            medications = result.get("medications", [])
-            
             # Build comprehensive response
-            content = f"Based on your query, this appears to be related to {condition}. "
-            content += f"{advice}"
-            
-            if medications:
-                med_names = [med.get("name", "Unknown") for med in medications]
-                content += f"\n\nSuggested medications: {', '.join(med_names)}"
+            content = format_ask_intro(result.get("condition", "your condition"), result.get("general_advice", ""))
+            content += format_ask_medications(result.get("medications", []))
         
-        return {"content": content}
+        response = {"content": content}
+        if "error" not in result and config.ASK_CACHE_SIZE > 0:
+            store_ask_answer(cache_key, embedding, response)
+        return response
         
     except Exception as e:
         logger.error(f"Error in /ask: {e}", exc_info=True)
         raise HTTPException(500, str(e))
 
+def sse_event(payload: Dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+@app.post("/ask/stream")
+async def ask_question_stream(payload: AskPayload):
+    """
+    Server-Sent Events variant of /ask
+    
+    The condition and advice come straight from the knowledge base, so they are
+    sent as soon as retrieval finishes; the suggested medications follow once
+    the LLM has produced its structured output. Clients join the "delta" fields.
+    """
+    
+    async def events():
+        try:
+            cache_key, embedding, cached = await find_cached_answer(payload.question)
+            if cached is not None:
+                yield sse_event({"delta": cached["content"]})
+                yield sse_event({"done": True})
+                return
+            
+            full_context = await rag.aresolve_context(payload.question, embedding)
+            if not full_context:
+                yield sse_event({"delta": ASK_FALLBACK_ANSWER})
+                yield sse_event({"done": True})
+                return
+            
+            intro = format_ask_intro(
+                full_context.get("condition_name", "Unknown"),
+                full_context.get("general_advice", "Follow medication instructions carefully.")
+            )
+            yield sse_event({"delta": intro})
+            
+            result = await rag.agenerate(payload.question, full_context=full_context)
+            if "error" in result:
+                yield sse_event({"done": True})
+                return
+            tail = format_ask_medications(result.get("medications", []))
+            if tail:
+                yield sse_event({"delta": tail})
+            if config.ASK_CACHE_SIZE > 0:
+                store_ask_answer(cache_key, embedding, {"content": intro + tail})
+            yield sse_event({"done": True})
+        
+        except Exception as e:
+            logger.error(f"Error in /ask/stream: {e}", exc_info=True)
+            yield sse_event({"error": str(e)})
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 if __name__ == "__main__":
     uvicorn.run(
         "inference_service:app",
         host="0.0.0.0",
         port=8001,
         reload=False,
-        log_level="info"
+        log_level="info",
+        # "auto" picks uvloop/httptools when installed (uvicorn[standard] on
+        # Linux/macOS) and falls back to asyncio/h11 elsewhere, e.g. Windows
+        loop="auto",
+        http="auto",
+        workers=config.WORKERS,
+        limit_concurrency=config.LIMIT_CONCURRENCY,
+        timeout_keep_alive=config.KEEP_ALIVE_TIMEOUT
     )
\ No newline at end of file
@@ -1,8 +1,20 @@
+import asyncio
+import copy
+import hashlib
 import json
 import logging
-from typing import List, Dict, Optional
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
@@ -14,12 +26,13 @@ You are a highly precise medical data structuring tool. Your task is to convert
 - Your response MUST be ONLY the JSON object, with no extra text, markdown, or explanations.
 """
 
-def create_final_prescription_prompt(transcription: str, age: int = 30, weight: float = 70.0) -> str:
-    default_expiry = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
+def _build_system_prompt() -> str:
+    """SYSTEM_PROMPT plus the schema and rules, identical on every call so Ollama can reuse its KV cache"""
     json_schema = {
       "patientEmail": "<infer or leave as 'patient@example.com'>", "patientMobile": "<infer or leave as '+1234567890'>",
-      "age": age, "weight": weight, "height": "<infer a reasonable height in cm or provide a default like 170>",
-      "usageLimit": 1, "expiresAt": f"<default to '{default_expiry}'>",
+      "age": "<patient age from Patient Info, as a number>", "weight": "<patient weight in kg from Patient Info, as a number>",
+      "height": "<infer a reasonable height in cm or provide a default like 170>",
+      "usageLimit": 1, "expiresAt": "<default to the Default expiry date from Patient Info>",
       "instructions": "<provide a brief, general instruction based on the context>",
       "medications": [{
           "name": "<name of the medication>", "dosage": "<e.g., 500mg>",
@@ -28,10 +41,8 @@ def create_final_prescription_prompt(transcription: str, age: int = 30, weight:
           "duration": "<e.g., 7 days>", "instructions": "<specific instructions for this medication>"
       }]
     }
-    return f"""
-Task: Populate the following JSON schema based on the provided clinical transcription.
-Transcription: "{transcription}"
-Patient Info: - Age: {age} - Weight: {weight} kg
+    return SYSTEM_PROMPT + f"""
+Task: Populate the following JSON schema based on the clinical transcription in the user message.
 Strict JSON Schema to fill:
 {json.dumps(json_schema, indent=2)}
 Remember the rules:
@@ -39,19 +50,68 @@ Remember the rules:
 3. Your response MUST be the JSON object ONLY.
 """
 
+SYSTEM_WITH_SCHEMA = _build_system_prompt()
+JSON_DECODER = json.JSONDecoder()
+
+@lru_cache(maxsize=1)
+def _default_expiry(today: date) -> str:
+    return (today + timedelta(days=30)).strftime('%Y-%m-%d')
+
+def create_final_prescription_prompt(transcription: str, age: int = 30, weight: float = 70.0) -> str:
+    """Per-request user message; everything invariant lives in SYSTEM_WITH_SCHEMA"""
+    return (
+        f'Transcription: "{transcription}"\n'
+        f"Patient Info: - Age: {age} - Weight: {weight} kg - Default expiry: {_default_expiry(date.today())}"
+    )
+
+class LeaderCancelled(Exception):
+    """Set on a shared in-flight Ollama call whose owning task was cancelled"""
+
 class MedicalLLM:
     def __init__(self, ollama_url: str = "http://localhost:11434"):
         self.ollama_url = ollama_url
         self.model_name = os.getenv("OLLAMA_MODEL", "meditron:7b")
+        # LRU of parsed LLM replies keyed by a hash of model, messages and options
+        self.cache_size = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+        self._cache: "OrderedDict[bytes, Dict]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Async calls for a prompt already in flight await the same future
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        try:
+            import ollama
+        except ImportError:
+            ollama = None
+        
+        if ollama is None:
+            self.client = None
+            self.aclient = None
+        else:
+            # httpx is the ollama client's own transport, so it is installed alongside it
+            import httpx
+            # Shared keep-alive pool. A non-streamed generation can take minutes on CPU,
+            # so reads are unbounded unless OLLAMA_READ_TIMEOUT (seconds) is set
+            read_timeout = os.getenv("OLLAMA_READ_TIMEOUT")
+            transport_kwargs = {
+                "timeout": httpx.Timeout(float(read_timeout) if read_timeout else None, connect=10.0),
+                "limits": httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0),
+            }
+            # One client per instance keeps a pooled keep-alive connection to
+            # ollama_url instead of going through the module-level default host
+            self.client = ollama.Client(host=ollama_url, **transport_kwargs)
+            # Async client for batch calls; run Ollama with OLLAMA_NUM_PARALLEL > 1
+            # so the server actually decodes concurrent requests in parallel
+            self.aclient = ollama.AsyncClient(host=ollama_url, **transport_kwargs)
         self._ensure_model_available()
     
     def _ensure_model_available(self):
+        if self.client is None:
+            logger.error("❌ 'ollama' package not installed. Run: pip install ollama")
+            return
+        
         try:
-            import ollama
-            
             # Test connection first
             try:
-                response = ollama.list()
+                response = self.client.list()
                 logger.info("✅ Successfully connected to Ollama")
             except Exception as conn_error:
                 logger.error(f"❌ Could not connect to Ollama: {conn_error}")
@@ -97,76 +157,192 @@ class MedicalLLM:
             else:
                 logger.info(f"✅ LLM Model '{self.model_name}' is available.")
                 
-        except ImportError:
-            logger.error("❌ 'ollama' package not installed. Run: pip install ollama")
         except Exception as e:
             logger.error(f"❌ Unexpected error checking Ollama: {e}")
 
     def generate_full_prescription(self, transcription: str, age: int, weight: float) -> Dict:
         prompt = create_final_prescription_prompt(transcription, age, weight)
         try:
-            response_text = self._call_ollama(prompt)
-            return self._parse_response(response_text)
+            # Copy so callers never mutate the cached (and possibly shared) reply
+            return copy.deepcopy(self._call_ollama(prompt))
         except Exception as e:
             logger.error(f"LLM prescription generation failed: {e}")
             return self._create_fallback_prescription(transcription, age, weight)
     
-    def _call_ollama(self, prompt: str) -> str:
+    async def agenerate_full_prescription(self, transcription: str, age: int, weight: float) -> Dict:
+        prompt = create_final_prescription_prompt(transcription, age, weight)
         try:
-            import ollama
-        except ImportError:
+            # Copy so callers never mutate the cached (and possibly shared) reply
+            return copy.deepcopy(await self._acall_ollama(prompt))
+        except Exception as e:
+            logger.error(f"LLM prescription generation failed: {e}")
+            return self._create_fallback_prescription(transcription, age, weight)
+    
+    async def agenerate_full_prescription_batch(self, items: List[Tuple[str, int, float]]) -> List[Dict]:
+        """Generate prescriptions for (transcription, age, weight) items concurrently"""
+        return await asyncio.gather(*[self.agenerate_full_prescription(*item) for item in items])
+    
+    def generate_full_prescription_batch(self, items: List[Tuple[str, int, float]]) -> List[Dict]:
+        """Sync counterpart of agenerate_full_prescription_batch, fanned out over the sync client"""
+        if not items:
+            return []
+        # Threads rather than asyncio.run: the AsyncClient's pooled connections are bound to one loop.
+        # Capped at the server's decode slots so a large batch queues here instead of flooding Ollama
+        max_workers = min(len(items), max(1, int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(lambda item: self.generate_full_prescription(*item), items))
+    
+    def _chat_messages(self, prompt: str) -> List[Dict]:
+        return [
+            {'role': 'system', 'content': SYSTEM_WITH_SCHEMA},
+            {'role': 'user', 'content': prompt}
+        ]
+    
+    def _chat_options(self) -> Dict:
+        # Fixed seed keeps sampling reproducible across calls that share the cached system prefix
+        return {"temperature": 0.1, "seed": 0}
+    
+    def _extract_content(self, response) -> str:
+        if isinstance(response, dict):
+            if 'message' in response and isinstance(response['message'], dict):
+                content = response['message'].get('content', '')
+                if content:
+                    logger.info("✅ Got response from Ollama")
+                    return content
+            if 'content' in response:
+                content = response.get('content', '')
+                if content:
+                    logger.info("✅ Got response from Ollama")
+                    return content
+        
+        raise ValueError('Empty or invalid response from ollama')
+    
+    def _cache_key(self, prompt: str) -> bytes:
+        request = [self.model_name, self._chat_messages(prompt), self._chat_options()]
+        if orjson is not None:
+            request = orjson.dumps(request, option=orjson.OPT_SORT_KEYS)
+        else:
+            request = json.dumps(request, sort_keys=True).encode()
+        return hashlib.blake2b(request, digest_size=16).digest()
+    
+    def _cache_get(self, key: bytes) -> Optional[Dict]:
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                logger.info("✅ LLM cache hit")
+            return cached
+    
+    def _cache_put(self, key: bytes, parsed: Dict):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = parsed
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def _call_ollama(self, prompt: str) -> Dict:
+        if self.client is None:
             raise Exception("ollama package not installed")
         
+        cache_key = self._cache_key(prompt)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
             logger.info(f"Calling Ollama with model: {self.model_name}")
-            response = ollama.chat(
+            response = self.client.chat(
                 model=self.model_name,
-                messages=[
-                    {'role': 'system', 'content': SYSTEM_PROMPT},
-                    {'role': 'user', 'content': prompt}
-                ],
-                options={
-                    "temperature": 0.1,
-                    "timeout": 30  # 30 second timeout
-                }
+                messages=self._chat_messages(prompt),
+                options=self._chat_options()
             )
+            content = self._extract_content(response)
+        except Exception as e:
+            logger.error(f"Error calling Ollama: {e}")
+            raise
+        
+        # _parse_response logs its own decode error; only parsed replies are cached,
+        # so a retry can recover from a bad one
+        parsed = self._parse_response(content)
+        self._cache_put(cache_key, parsed)
+        return parsed
+    
+    async def _acall_ollama(self, prompt: str) -> Dict:
+        if self.aclient is None:
+            raise Exception("ollama package not installed")
+        
+        cache_key = self._cache_key(prompt)
+        while True:
+            cached = self._cache_get(cache_key)
+            if cached is not None:
+                return cached
             
-            if isinstance(response, dict):
-                if 'message' in response and isinstance(response['message'], dict):
-                    content = response['message'].get('content', '')
-                    if content:
-                        logger.info("✅ Got response from Ollama")
-                        return content
-                if 'content' in response:
-                    content = response.get('content', '')
-                    if content:
-                        logger.info("✅ Got response from Ollama")
-                        return content
+            # Single-flight: identical concurrent prompts share one Ollama call
+            inflight = self._inflight.get(cache_key)
+            if inflight is None:
+                break
+            try:
+                return await asyncio.shield(inflight)
+            except LeaderCancelled:
+                # The caller making the shared request was cancelled; retry, taking over if first
+                continue
+        
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = future
+        try:
+            try:
+                logger.info(f"Calling Ollama (async) with model: {self.model_name}")
+                response = await self.aclient.chat(
+                    model=self.model_name,
+                    messages=self._chat_messages(prompt),
+                    options=self._chat_options()
+                )
+                content = self._extract_content(response)
+            except Exception as e:
+                logger.error(f"Error calling Ollama: {e}")
+                raise
             
-            raise ValueError('Empty or invalid response from ollama')
+            # _parse_response logs its own decode error; only parsed replies are cached,
+            # so a retry can recover from a bad one
+            parsed = self._parse_response(content)
+            self._cache_put(cache_key, parsed)
+            future.set_result(parsed)
+            return parsed
             
         except Exception as e:
-            logger.error(f"Error calling Ollama: {e}")
+            future.set_exception(e)
+            future.exception()  # Mark retrieved so an unawaited failure isn't logged again
+            raise
+        except BaseException:
+            # Cancelled: hand the prompt back to any waiters instead of cancelling them
+            future.set_exception(LeaderCancelled())
+            future.exception()
             raise
+        finally:
+            del self._inflight[cache_key]
 
     def _parse_response(self, response: str) -> Dict:
         try:
-            # Clean the response
-            response = response.strip()
-            
             # Find JSON object
             start_idx = response.find('{')
             end_idx = response.rfind('}') + 1
             
             if start_idx != -1 and end_idx != 0:
-                json_str = response[start_idx:end_idx]
-                parsed = json.loads(json_str)
+                try:
+                    json_str = response[start_idx:end_idx]
+                    parsed = orjson.loads(json_str) if orjson is not None else json.loads(json_str)
+                except ValueError:
+                    # Trailing prose with its own braces: decode only the first complete
+                    # object, which the stdlib scanner finds in one forward pass
+                    parsed, _ = JSON_DECODER.raw_decode(response, start_idx)
                 logger.info("✅ Successfully parsed LLM response")
                 return parsed
             else:
                 raise ValueError("No JSON object found in response")
                 
-        except (json.JSONDecodeError, ValueError) as e:
+        except ValueError as e:
+            # json and orjson decode errors are both ValueError subclasses
             logger.error(f"Failed to decode JSON from LLM response: {response[:200]}... | Error: {e}")
             raise ValueError("LLM response was not valid JSON")
 
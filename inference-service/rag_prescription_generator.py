@@ -1,19 +1,28 @@
+import asyncio
+import hashlib
 import json
 import logging
-from typing import Dict, List
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
 
 import os
+import numpy as np
+import torch
 # ✅ Modernized imports for LangChain ≥1.0
-from langchain_community.vectorstores import Chroma
-from langchain_community.vectorstores.utils import filter_complex_metadata
-from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnablePassthrough
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_ollama import OllamaLLM as Ollama
+import ollama
 from langchain_core.output_parsers import JsonOutputParser
 from pydantic import BaseModel, Field     # ← Pydantic v2 handles this directly
 
+try:
+    from usearch.index import Index as USearchIndex
+except ImportError:
+    USearchIndex = None
 
 
 logger = logging.getLogger(__name__)
@@ -34,6 +43,69 @@ class PrescriptionOutput(BaseModel):
     medications: List[Medication] = Field(description="A list of all the prescribed medications.")
 
 
+# --- Rule-based fallback dosing, used when the LLM step fails ---
+# Built once at import; callers copy entries via {"name": ..., **details}.
+MEDICATION_DEFAULTS = {
+    "Acetaminophen": {"dosage": "500mg", "frequency": "every 6 hours", "timing": "as needed for fever", "duration": "3 days", "quantity": 12, "instructions": "Do not exceed 4000mg per day."},
+    "Ibuprofen": {"dosage": "400mg", "frequency": "twice daily", "timing": "with meals", "duration": "5 days", "quantity": 10, "instructions": "Take with food to prevent stomach upset."},
+    "Cetirizine": {"dosage": "10mg", "frequency": "once daily", "timing": "in the evening", "duration": "7 days", "quantity": 7, "instructions": "May cause drowsiness."},
+    "Loratadine": {"dosage": "10mg", "frequency": "once daily", "timing": "in the morning", "duration": "7 days", "quantity": 7, "instructions": "Non-drowsy formula."},
+    "Antacid": {"dosage": "10ml", "frequency": "thrice daily", "timing": "after meals", "duration": "5 days", "quantity": 1, "instructions": "Shake well before use."},
+    "Ondansetron": {"dosage": "4mg", "frequency": "twice daily", "timing": "as needed for nausea", "duration": "3 days", "quantity": 6, "instructions": "Allow to dissolve on tongue."},
+    "Loperamide": {"dosage": "2mg", "frequency": "after each loose stool", "timing": "as needed", "duration": "2 days", "quantity": 8, "instructions": "Do not exceed 16mg per day."},
+    "Naproxen": {"dosage": "250mg", "frequency": "twice daily", "timing": "with meals", "duration": "5 days", "quantity": 10, "instructions": "For pain and inflammation."},
+    "Hydrocortisone Cream": {"dosage": "1% cream", "frequency": "twice daily", "timing": "morning and evening", "duration": "7 days", "quantity": 1, "instructions": "Apply a thin layer to the affected area."},
+    "Dextromethorphan Syrup": {"dosage": "10ml", "frequency": "every 6 hours", "timing": "as needed for cough", "duration": "5 days", "quantity": 1, "instructions": "For dry, non-productive cough only."}
+}
+DEFAULT_MEDICATION_DETAILS = {
+    "dosage": "As directed", "frequency": "As directed", "timing": "As directed", 
+    "duration": "As directed", "quantity": 1, "instructions": "Follow physician's instructions."
+}
+
+
+# --- Query Embedding Micro-Batcher ---
+class QueryEmbeddingBatcher:
+    """Coalesces concurrent embed_query calls into a single embed_documents batch."""
+
+    def __init__(self, embeddings, max_batch_size: int = 32, max_wait_ms: int = 5):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="query-embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def embed_query(self, text: str) -> List[float]:
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                vectors = self.embeddings.embed_documents([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+
 # --- Main RAG Class ---
 class RAGPrescriptionGenerator:
     def __init__(self, data_path="medical_data.json"):
@@ -47,17 +119,49 @@ class RAGPrescriptionGenerator:
         if not os.path.exists(data_path):
             raise FileNotFoundError(f"Knowledge base file not found: {data_path}")
 
-        self.llm = Ollama(model=self.model_name, temperature=0.1, format="json")
-        self.embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+        # Direct Ollama client: the pipeline only needs the raw JSON string back
+        self._ollama_async = ollama.AsyncClient(host=os.getenv("OLLAMA_HOST", "http://localhost:11434"))
+        self._ollama_options = {
+            "temperature": 0.1,
+            "seed": 0,
+            "num_predict": int(os.getenv("RAG_NUM_PREDICT", "512")),
+        }
+        embedder_backend = os.getenv("RAG_EMBEDDER_BACKEND", "onnx")
+        model_kwargs = {"backend": embedder_backend}
+        if embedder_backend == "onnx":
+            # The hub repo ships pre-quantized graphs; AVX2 INT8 runs on any modern x86 CPU
+            model_kwargs["model_kwargs"] = {
+                "file_name": os.getenv("RAG_EMBEDDER_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+            }
+        self.embeddings = HuggingFaceEmbeddings(
+            model_name="all-MiniLM-L6-v2",
+            model_kwargs=model_kwargs,
+            encode_kwargs={"normalize_embeddings": True},
+        )
+        if embedder_backend == "torch" and os.getenv("RAG_EMBEDDER_INT8", "1") == "1":
+            self._quantize_embedder()
+        self._embedder_id = f"all-MiniLM-L6-v2 {model_kwargs}"
+        self._query_batcher = QueryEmbeddingBatcher(
+            self.embeddings,
+            max_batch_size=int(os.getenv("RAG_EMBED_BATCH_SIZE", "32")),
+            max_wait_ms=int(os.getenv("RAG_EMBED_BATCH_WAIT_MS", "5")),
+        )
+        
+        cache_path = os.getenv("RAG_EMBEDDING_CACHE_PATH", "embeddings_cache.npy")
+        if not os.path.isabs(cache_path):
+            cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), cache_path)
+        self._embedding_cache_path = cache_path
         
         self._raw_kb = self._load_data(data_path)
-        self._condition_by_name = {
-            item.get("condition_name", "").strip().lower(): item for item in self._raw_kb if item.get("condition_name")
-        }
         
-        self.vector_store = self._create_vector_store_from_items(self._raw_kb)
-        # ENHANCEMENT: Increased retriever 'k' to 3 to get more context
-        self.retriever = self.vector_store.as_retriever(search_kwargs={"k": 3})
+        # Unit-norm (N, d) FP16 matrix, one row per KB item, memory-mapped from the cache when possible.
+        self._kb_embeddings = self._embed_items(self._raw_kb)
+        self._kb_index = self._build_index(self._kb_embeddings)
+        # Without an index, cosine similarity is a single float32 matmul (NumPy has no FP16 GEMV)
+        self._kb_matrix = (
+            np.ascontiguousarray(self._kb_embeddings, dtype=np.float32)
+            if self._kb_index is None else None
+        )
 
         # ENHANCEMENT: Switched to the more reliable JsonOutputParser
         self.parser = JsonOutputParser(pydantic_object=PrescriptionOutput)
@@ -88,14 +192,6 @@ class RAGPrescriptionGenerator:
             return formatted
         
         self._format_context = format_context
-        
-        # The RAG chain now properly formats context before passing to prompt
-        self.rag_chain = (
-            RunnablePassthrough.assign(context=lambda x: format_context(x.get("context", {})))
-            | self.prompt_template
-            | self.llm
-            | self.parser
-        )
         logger.info(f"✅ RAG Generator initialized successfully with JSON parser. Loaded {len(self._raw_kb)} conditions from knowledge base.")
 
     def _load_data(self, data_path: str) -> List[Dict]:
@@ -135,9 +231,6 @@ class RAGPrescriptionGenerator:
             logger.error(f"❌ Failed to load knowledge base from {data_path}: {e}")
             raise
 
-    def _normalize(self, s: str) -> str:
-        return s.strip().lower() if s else ""
-
     def _find_best_by_text(self, text: str):
         t = text.lower()
         for item in self._raw_kb:
@@ -150,9 +243,18 @@ class RAGPrescriptionGenerator:
                     return item
         return None
 
-    def _create_vector_store_from_items(self, items: List[Dict]):
-        """Create vector store from JSON knowledge base items."""
-        documents = []
+    def _quantize_embedder(self):
+        """Swap the sentence-transformer's Linear layers for dynamic INT8 ones on CPU."""
+        client = getattr(self.embeddings, "_client", None) or getattr(self.embeddings, "client", None)
+        if client is None or client.device.type != "cpu":
+            return
+        # INT8 weights + FBGEMM GEMMs for the Linear layers; activations stay FP32
+        torch.ao.quantization.quantize_dynamic(client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        logger.info("✅ Enabled dynamic INT8 quantization for the embedder")
+
+    def _embed_items(self, items: List[Dict]) -> np.ndarray:
+        """Embed JSON knowledge base items into a normalized FP16 matrix."""
+        texts = []
         for item in items:
             condition_name = item.get('condition_name', 'Unknown')
             symptoms = item.get('symptoms', [])
@@ -164,16 +266,110 @@ class RAGPrescriptionGenerator:
             search_content += f"Symptoms: {', '.join(symptoms) if symptoms else 'Not specified'}. "
             if drug_names:
                 search_content += f"Suggested medications: {', '.join(drug_names)}."
-            
-            simple_metadata = {"condition_name": condition_name}
-            documents.append(Document(page_content=search_content, metadata=simple_metadata))
+            texts.append(search_content)
+        
+        # The cache is only valid for the exact texts and embedder that produced it
+        fingerprint = hashlib.blake2b(
+            "\n".join([self._embedder_id, *texts]).encode("utf-8"), digest_size=16
+        ).hexdigest()
+        cached = self._load_cached_embeddings(fingerprint, len(texts))
+        if cached is not None:
+            logger.info(f"Loaded {len(cached)} KB embeddings from {self._embedding_cache_path}")
+            return cached
         
-        filtered_documents = filter_complex_metadata(documents)
-        logger.info(f"Creating vector store with {len(filtered_documents)} documents from JSON knowledge base...")
-        return Chroma.from_documents(documents=filtered_documents, embedding=self.embeddings)
+        logger.info(f"Embedding {len(texts)} documents from JSON knowledge base...")
+        embeddings = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings = (embeddings / norms).astype(np.float16)
+        self._save_cached_embeddings(embeddings, fingerprint)
+        return embeddings
+
+    def _load_cached_embeddings(self, fingerprint: str, count: int):
+        """Memory-map the FP16 embeddings cache, or return None if missing or stale."""
+        key_path = self._embedding_cache_path + ".key"
+        try:
+            with open(key_path, "r", encoding="utf-8") as f:
+                if f.read().strip() != fingerprint:
+                    return None
+            # Pages fault in lazily and are shared through the page cache across uvicorn workers
+            embeddings = np.load(self._embedding_cache_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        if embeddings.ndim != 2 or len(embeddings) != count or embeddings.dtype != np.float16:
+            return None
+        return embeddings
+
+    def _save_cached_embeddings(self, embeddings: np.ndarray, fingerprint: str):
+        """Persist normalized FP16 embeddings next to their fingerprint.
+        Both files are written to temp names and renamed into place (data first, key
+        last), so other workers never mmap a file that is being rewritten and a crash
+        never leaves a key that vouches for the wrong data."""
+        key_path = self._embedding_cache_path + ".key"
+        cache_dir = os.path.dirname(self._embedding_cache_path)
+        prefix = os.path.basename(self._embedding_cache_path) + "."
+        tmp_paths = []
+        try:
+            fd, tmp_data = tempfile.mkstemp(dir=cache_dir, prefix=prefix, suffix=".tmp")
+            tmp_paths.append(tmp_data)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, embeddings)
+            fd, tmp_key = tempfile.mkstemp(dir=cache_dir, prefix=prefix, suffix=".tmp")
+            tmp_paths.append(tmp_key)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(fingerprint)
+            # Drop the old key first so a crash before the final rename reads as a cache miss
+            if os.path.exists(key_path):
+                os.remove(key_path)
+            os.replace(tmp_data, self._embedding_cache_path)
+            os.replace(tmp_key, key_path)
+        except OSError as e:
+            logger.warning(f"Could not write embeddings cache: {e}")
+        finally:
+            for path in tmp_paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _build_index(self, embeddings: np.ndarray):
+        """Build an HNSW index over the KB embeddings when usearch is installed and the
+        KB is large enough for approximate search to beat an exact matmul."""
+        # Below this many items the exact scan is as fast and never misses the true best match
+        min_items = int(os.getenv("RAG_HNSW_MIN_ITEMS", "20000"))
+        if USearchIndex is None or len(embeddings) < max(min_items, 1):
+            return None
+        index = USearchIndex(
+            ndim=embeddings.shape[1],
+            metric="cos",
+            dtype="f16",
+            connectivity=24,
+            expansion_add=128,
+            expansion_search=100,
+        )
+        index.add(np.arange(len(embeddings), dtype=np.uint64), embeddings)
+        logger.info(f"Built HNSW index over {len(embeddings)} KB embeddings")
+        return index
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Return the normalized float32 embedding of a query string."""
+        return np.asarray(self._query_batcher.embed_query(text), dtype=np.float32)
+
+    def _find_best_by_embedding(self, text: str, query_embedding: Optional[np.ndarray] = None):
+        """Return the KB item whose embedding is most cosine-similar to the text.
+        Pass query_embedding from embed_query() to avoid embedding the text twice."""
+        if not len(self._kb_embeddings):
+            return None
+        query = query_embedding if query_embedding is not None else self.embed_query(text)
+        if self._kb_index is not None:
+            matches = self._kb_index.search(query, 1)
+            return self._raw_kb[int(matches.keys[0])] if len(matches.keys) else None
+        sims = self._kb_matrix @ query
+        return self._raw_kb[int(np.argmax(sims))]
 
     def _get_prompt_template(self) -> PromptTemplate:
         """Create prompt template that works with JSON knowledge base context."""
+        # Everything before CONTEXT is constant, so Ollama reuses its KV cache for that prefix
         template = """You are a precise medical data structuring tool. Based on the provided CONTEXT from the medical knowledge base, generate a JSON object for the user's prescription request.
 
 The CONTEXT contains information from the medical knowledge base including:
@@ -199,14 +395,14 @@ IMPORTANT:
 - Be specific and medically appropriate
 - Include safety instructions when relevant
 
+OUTPUT FORMAT INSTRUCTIONS:
+{format_instructions}
+
 CONTEXT FROM KNOWLEDGE BASE:
 {context}
 
 USER'S DESCRIPTION/TRANSCRIPTION:
 "{question}"
-
-OUTPUT FORMAT INSTRUCTIONS:
-{format_instructions}
 """
         return PromptTemplate(
             template=template,
@@ -216,95 +412,97 @@ OUTPUT FORMAT INSTRUCTIONS:
         
     def _get_default_medication_details(self, drug_name: str) -> Dict:
         """Returns a dictionary of default details for a given drug name."""
-        medication_defaults = {
-            "Acetaminophen": {"dosage": "500mg", "frequency": "every 6 hours", "timing": "as needed for fever", "duration": "3 days", "quantity": 12, "instructions": "Do not exceed 4000mg per day."},
-            "Ibuprofen": {"dosage": "400mg", "frequency": "twice daily", "timing": "with meals", "duration": "5 days", "quantity": 10, "instructions": "Take with food to prevent stomach upset."},
-            "Cetirizine": {"dosage": "10mg", "frequency": "once daily", "timing": "in the evening", "duration": "7 days", "quantity": 7, "instructions": "May cause drowsiness."},
-            "Loratadine": {"dosage": "10mg", "frequency": "once daily", "timing": "in the morning", "duration": "7 days", "quantity": 7, "instructions": "Non-drowsy formula."},
-            "Antacid": {"dosage": "10ml", "frequency": "thrice daily", "timing": "after meals", "duration": "5 days", "quantity": 1, "instructions": "Shake well before use."},
-            "Ondansetron": {"dosage": "4mg", "frequency": "twice daily", "timing": "as needed for nausea", "duration": "3 days", "quantity": 6, "instructions": "Allow to dissolve on tongue."},
-            "Loperamide": {"dosage": "2mg", "frequency": "after each loose stool", "timing": "as needed", "duration": "2 days", "quantity": 8, "instructions": "Do not exceed 16mg per day."},
-            "Naproxen": {"dosage": "250mg", "frequency": "twice daily", "timing": "with meals", "duration": "5 days", "quantity": 10, "instructions": "For pain and inflammation."},
-            "Hydrocortisone Cream": {"dosage": "1% cream", "frequency": "twice daily", "timing": "morning and evening", "duration": "7 days", "quantity": 1, "instructions": "Apply a thin layer to the affected area."},
-            "Dextromethorphan Syrup": {"dosage": "10ml", "frequency": "every 6 hours", "timing": "as needed for cough", "duration": "5 days", "quantity": 1, "instructions": "For dry, non-productive cough only."}
+        return MEDICATION_DEFAULTS.get(drug_name, DEFAULT_MEDICATION_DETAILS)
+
+    def _resolve_context(self, transcription: str, query_embedding: Optional[np.ndarray] = None) -> Optional[Dict]:
+        """Find the knowledge base entry for a transcription, semantic search first."""
+        # Step 1: Find the closest condition by cosine similarity over the KB embeddings.
+        full_context = self._find_best_by_embedding(transcription, query_embedding)
+
+        # Step 2: If semantic search finds nothing, try a simple text-based fallback search.
+        if not full_context:
+            logger.warning("Semantic search found no match. Trying text fallback.")
+            full_context = self._find_best_by_text(transcription)
+            if not full_context:
+                logger.error("Fallback search also failed. Cannot determine context.")
+        return full_context
+
+    def _build_prompt(self, full_context: Dict, transcription: str) -> str:
+        return self.prompt_template.format(
+            context=self._format_context(full_context),
+            question=transcription
+        )
+
+    def _medications_from_response(self, llm_response: Optional[Dict]) -> List[Dict]:
+        if llm_response and 'medications' in llm_response:
+            medications = llm_response['medications']
+            logger.info(f"Successfully used LLM to generate {len(medications)} structured medication(s).")
+            return medications
+        # This helps catch cases where the LLM might return a malformed dict
+        raise ValueError("LLM response did not contain the expected 'medications' key.")
+
+    def _fallback_medications(self, suggested_drugs: List[Dict]) -> List[Dict]:
+        medications = []
+        for drug_info in suggested_drugs:
+            drug_name = drug_info.get("name")
+            if drug_name:
+                med_details = self._get_default_medication_details(drug_name)
+                medications.append({"name": drug_name, **med_details})
+        return medications
+
+    def _build_result(self, full_context: Dict, medications: List[Dict]) -> Dict:
+        condition_name = full_context.get("condition_name", "Unknown")
+        result = {
+            "general_advice": full_context.get("general_advice", "Follow medication instructions carefully."),
+            "medications": medications,
+            "condition": condition_name
         }
-        return medication_defaults.get(drug_name, {
-            "dosage": "As directed", "frequency": "As directed", "timing": "As directed", 
-            "duration": "As directed", "quantity": 1, "instructions": "Follow physician's instructions."
-        })
+        logger.info(f"✅ Generated prescription with {len(medications)} medication(s) for '{condition_name}'")
+        return result
 
-    def generate(self, transcription: str) -> Dict:
+    async def aresolve_context(self, transcription: str, query_embedding: Optional[np.ndarray] = None) -> Optional[Dict]:
+        """Knowledge base lookup only (no LLM), run in a worker thread."""
+        return await asyncio.to_thread(self._resolve_context, transcription, query_embedding)
+
+    async def agenerate(self, transcription: str, full_context: Optional[Dict] = None,
+                        query_embedding: Optional[np.ndarray] = None) -> Dict:
         """
         The main function to generate a prescription from a doctor's transcription.
-        This new version uses a more robust JSON parser and includes fallback logic.
+        Retrieval runs in a worker thread and the Ollama call is awaited on the
+        AsyncClient, so concurrent requests overlap their LLM I/O and Ollama can
+        batch them (see OLLAMA_NUM_PARALLEL). Falls back to rule-based medication
+        details if the LLM fails. Pass full_context from aresolve_context() to
+        skip the lookup, or query_embedding from embed_query() to skip re-embedding.
         """
         logger.info(f"Generating prescription for: '{transcription}'")
         try:
-            # Step 1: Retrieve matching documents from the vector store.
-            retrieved_docs = self.retriever.invoke(transcription)
-            if not retrieved_docs:
-                logger.warning("Could not find a matching condition in the knowledge base.")
-                return {"error": "Could not find a matching condition in the knowledge base."}
-
-            # Step 2: Rehydrate the full context from our knowledge base map.
-            retrieved_meta = retrieved_docs[0].metadata or {}
-            condition_name = retrieved_meta.get("condition_name", "Unknown")
-            full_context = self._condition_by_name.get(self._normalize(condition_name))
-
-            # Step 3: If lookup fails, try a simple text-based fallback search.
+            if full_context is None:
+                full_context = await self.aresolve_context(transcription, query_embedding)
             if not full_context:
-                logger.warning(f"Vector search found '{condition_name}', but lookup failed. Trying text fallback.")
-                full_context = self._find_best_by_text(transcription)
-                if not full_context:
-                    logger.error("Fallback search also failed. Cannot determine context.")
-                    return {"error": "Could not determine the medical context from the transcription."}
-                condition_name = full_context.get("condition_name", "Unknown")
-
-            general_advice = full_context.get("general_advice", "Follow medication instructions carefully.")
-            suggested_drugs = full_context.get("suggested_drugs", [])
+                return {"error": "Could not determine the medical context from the transcription."}
 
-            # Step 4: If the knowledge base has no drugs for this condition, return early.
+            # Step 3: If the knowledge base has no drugs for this condition, return early.
+            suggested_drugs = full_context.get("suggested_drugs", [])
             if not suggested_drugs:
-                logger.warning(f"No medications found in knowledge base for: {condition_name}")
-                return {"general_advice": general_advice, "medications": [], "condition": condition_name}
+                logger.warning(f"No medications found in knowledge base for: {full_context.get('condition_name', 'Unknown')}")
+                return self._build_result(full_context, [])
 
-            # Step 5: Format the full context from JSON knowledge base and use it in RAG chain.
-            medications = []
+            # Step 4: Ask the LLM to structure the knowledge base context as JSON.
             try:
-                # Format the full_context dict into a readable string for the LLM
-                formatted_context = self._format_context(full_context)
-                logger.info(f"Using formatted context for condition: {condition_name}")
-                
-                # The chain now directly outputs a parsed dictionary, not a raw string.
-                llm_response = self.rag_chain.invoke({
-                    "context": full_context,  # Pass dict, chain will format it
-                    "question": transcription
-                })
-                
-                if llm_response and 'medications' in llm_response:
-                    medications = llm_response['medications']
-                    logger.info(f"Successfully used LLM to generate {len(medications)} structured medication(s).")
-                else:
-                    # This helps catch cases where the LLM might return a malformed dict
-                    raise ValueError("LLM response did not contain the expected 'medications' key.")
-
+                response = await self._ollama_async.generate(
+                    model=self.model_name,
+                    prompt=self._build_prompt(full_context, transcription),
+                    format="json",
+                    options=self._ollama_options
+                )
+                medications = self._medications_from_response(self.parser.parse(response["response"]))
             except Exception as llm_err:
-                # Step 6: If the LLM fails, fall back to the rule-based method. This makes the system robust.
+                # Step 5: If the LLM fails, fall back to the rule-based method. This makes the system robust.
                 logger.warning(f"LLM enhancement failed: {llm_err}. Falling back to default medication details.")
-                for drug_info in suggested_drugs:
-                    drug_name = drug_info.get("name")
-                    if drug_name:
-                        med_details = self._get_default_medication_details(drug_name)
-                        medications.append({"name": drug_name, **med_details})
-
-            # Step 7: Construct and return the final, successful result.
-            result = {
-                "general_advice": general_advice,
-                "medications": medications,
-                "condition": condition_name
-            }
-            logger.info(f"✅ Generated prescription with {len(medications)} medication(s) for '{condition_name}'")
-            return result
+                medications = self._fallback_medications(suggested_drugs)
+
+            # Step 6: Construct and return the final, successful result.
+            return self._build_result(full_context, medications)
 
         except Exception as e:
             logger.error(f"❌ RAG pipeline failed unexpectedly: {e}", exc_info=True)